@@ -9,24 +9,27 @@ djmarinara does the following:
 5) Manages the playlist buffer to ensure limited disk space usage and a healthy buffer of queued songs.
 """
 
-import glob
 import hashlib
+import heapq
 import json
 import logging
 import os
 import random
-import re
 import shutil
 import subprocess
 import textwrap
 import time
+import urllib.error as error
 import urllib.parse as parse
 import urllib.request as request
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 from datetime import datetime
 from pathlib import Path
 
+from PIL import Image, ImageDraw, ImageFont
+
 __author__ = "James Huffman"
 __copyright__ = "Copyright 2020, James Huffman"
 __credits__ = ["James Huffman"]
@@ -47,25 +50,45 @@ class djmarinara:
                  startupvideo="",
                  gastanklimit=3600.0,
                  targetspeed=2.0):
-        self.extensions = extensions
-        self.temppath = temppath
+        self.extensions = frozenset(extensions)
+        self.temppath = temppath  # Unused since zip entries are streamed out directly; kept for compatibility
         self.mediapath = mediapath
         self.playlisturl = playlisturl
         self.fonturl = fonturl
         self.startupvideo = startupvideo
         self.gastanklimit = gastanklimit
-        self.listhash = ""
+        try:
+            self.listhash = Path(self.mediapath, '.listhash').read_text().strip()
+        except FileNotFoundError:
+            self.listhash = ""
+        self.listcandidates = []
+        self.listetag = ""
+        self.listmodified = ""
         self.linewidth = 80
+        # Built once; textwrap.wrap() would construct a new wrapper for every line.
+        self.wrapper = textwrap.TextWrapper(width=self.linewidth, expand_tabs=False, replace_whitespace=False,
+                                            drop_whitespace=False, break_long_words=False, break_on_hyphens=False)
         self.getFont()
         self.maxlength = (gastanklimit / 2.0)
-        self.manifest = open('manifest', 'r').read().split("\n")
-        self.crf = 17
+        with open('manifest', 'r') as f:
+            self.manifest = frozenset(line.strip() for line in f if line.strip())
+        self.crf = 17.0
         self.mincrf = 17  # Best quality with compression
         self.maxcrf = 28  # Worst acceptable quality
         self.targetspeed = targetspeed
         self.qualitypresets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower',
                                'veryslow']
-        self.preset = 0  # Use ultrafast to start
+        # Start at ultrafast, or a notch or two slower when there are enough cores to afford it.
+        # The speed controller takes it from there.
+        cores = os.cpu_count() or 1
+        self.preset = 2 if cores >= 8 else 1 if cores >= 4 else 0
+        self.speederror = 0.0  # Speed error from the last song, for the controller's proportional term
+        self.nvencpreset = 1.0  # p1 (fastest) to p7 (slowest); fractional so the controller can move it smoothly
+        self.encoder = self.detectEncoder()
+        # Downloads the next song while the current one renders.
+        self.downloader = ThreadPoolExecutor(max_workers=1)
+        self.prefetch = None  # (url, filename, future)
+        self.startupfetch = None
 
         now_str = datetime.now().strftime("%y%m%d_%H%M%S")
         logging.basicConfig(filename=f'djmarinara-{now_str}.log', encoding='utf-8', level=logging.DEBUG)
@@ -74,7 +97,7 @@ class djmarinara:
         self.gastank = 0
         self.getFileNumber()
         self.elapsedtime = 0.0
-        self.starttime = time.time()
+        self.starttime = time.monotonic()
 
     def run(self):
         self.initRun()
@@ -85,74 +108,115 @@ class djmarinara:
     def sanityCheck(self):
         if not os.path.exists(os.path.join(self.mediapath, "playlist0.txt")):
             logging.error("Playlist sanity check failed. Fixing...")
-            outfile = open('/media/playlist0.txt', 'w')
-            outfile.write("ffconcat version 1.0\n")
-            outfile.write("file startup.flv\n")
-            outfile.write("file playlist1.txt\n")
-            outfile.close()
-            outfile = open('/media/playlist1.txt', 'w')
-            outfile.write("ffconcat version 1.0\n")
-            outfile.write("file startup.flv\n")
-            outfile.write("file playlist0.txt\n")
-            outfile.close()
+            self.writePlaylist(os.path.join(self.mediapath, "playlist0.txt"), "startup.flv", "playlist1.txt")
+            self.writePlaylist(os.path.join(self.mediapath, "playlist1.txt"), "startup.flv", "playlist0.txt")
             self.filenumber = 0
-        if not os.path.exists(os.path.join(self.mediapath, "startup.flv")):
+        if os.path.exists(os.path.join(self.mediapath, "startup.flv")):
+            # Present again (or never missing); if it disappears later, that's a fresh start.
+            self.startupfetch = None
+        elif self.startupfetch is None:
             logging.error("Startup video sanity check failed. Fixing...")
-            with closing(request.urlopen(self.startupvideo)) as r:
-                logging.info(f'Opening URL: {self.startupvideo}')
-                with open("/media/startup.flv", 'wb') as f:
-                    logging.info("Downloading: /media/startup.flv")
-                    shutil.copyfileobj(r, f)
+            # Nothing here needs the video itself, so fetch it on the download worker
+            # and get on with polling the playlist and rendering in the meantime.
+            self.startupfetch = self.downloader.submit(self.getStartupVideo)
             self.filenumber = 0
+        elif self.startupfetch.done():
+            # The last attempt failed. Songs may have been queued since, so only retry the
+            # download; resetting filenumber now would overwrite them and break the chain.
+            logging.error("Retrying startup video download...")
+            self.startupfetch = self.downloader.submit(self.getStartupVideo)
 
     def getFont(self):
-        with closing(request.urlopen(self.fonturl)) as r:
-            logging.info(f'Opening URL: {self.fonturl}')
-            with open('font.ttf', 'wb') as f:
-                logging.info("Downloading: font.ttf")
-                shutil.copyfileobj(r, f)
+        self.streamToFile(self.fonturl, 'font.ttf')
+
+    def getStartupVideo(self):
+        # Download under a temporary name so a partial file never passes the sanity check.
+        # Failures are only logged; the next sanity check will try again.
+        partfile = os.path.join(self.mediapath, "startup.flv.part")
+        try:
+            self.streamToFile(self.startupvideo, partfile)
+            os.replace(partfile, os.path.join(self.mediapath, "startup.flv"))
+        except Exception as e:
+            logging.error(f'Failed to download startup video: {self.startupvideo}')
+            logging.error(e)
+
+    def streamToFile(self, url, path, chunksize=1 << 20):
+        # Read straight into one buffer that's reused for every chunk,
+        # and write unbuffered so the data isn't copied a second time.
+        # The buffer is per call, since song downloads run on a background thread.
+        buf = bytearray(chunksize)
+        view = memoryview(buf)
+        with closing(request.urlopen(url)) as r:
+            logging.info(f'Opening URL: {url}')
+            with open(path, 'wb', buffering=0) as f:
+                logging.info(f'Downloading: {path}')
+                while n := r.readinto(view):
+                    f.write(view[:n])
 
     def getFileNumber(self):
         try:
-            filelist = glob.glob(self.mediapath + '/*.txt')
-            filelist.sort(key=self.naturalKeys)
-            lastfile = filelist[-1]
-            lastnumber = int(''.join(list(filter(str.isdigit, lastfile))))
+            numbers = [self.fileNumber(name, 'playlist', '.txt') for name in os.listdir(self.mediapath)]
+            lastnumber = max(number for number in numbers if number is not None)
             # False positive caused by the presence of 2 initial playlists!
             # Just reset back to 1 if we find it
             if lastnumber == 1:
                 lastnumber = 0
-        except:
+        except (OSError, ValueError):
             logging.error("Couldn't find valid startup files!")
             lastnumber = 0
         logging.info(f'File number is now: {lastnumber}')
         self.filenumber = lastnumber
 
     def playlistCheck(self):
-        with closing(request.urlopen(self.playlisturl)) as r:
-            hasher = hashlib.md5()
-            buf = r.read()
-            hasher.update(buf)
-            newhash = hasher.hexdigest()
-            # Update the playlist immediately if the source file changed!
-            # Otherwise, check the gas tank. Pre-render if we're not full.
-            # If we're full, just sleep for 60 seconds.
-            if (newhash != self.listhash):
-                logging.info("Remote playlist updated!")
-                self.listhash = newhash
-                self.updatePlaylist(str(buf))
-            elif self.checkGas() < self.gastanklimit:
-                logging.info(f'Filling up gas tank! ({self.gastank} of {self.gastanklimit} seconds ready...)')
-                self.updatePlaylist(str(buf))
-            else:
-                logging.info(f'Gas tank is at {self.gastank} seconds, so wait...')
-                # Sleep until the gas tank falls below full.
-                time.sleep(self.gastank - self.gastanklimit)
+        # Send validators from the last fetch so an unchanged playlist costs a 304 and nothing else.
+        headers = {}
+        if self.listetag:
+            headers['If-None-Match'] = self.listetag
+        if self.listmodified:
+            headers['If-Modified-Since'] = self.listmodified
+        newhash = self.listhash
+        buf = None
+        try:
+            with closing(request.urlopen(request.Request(self.playlisturl, headers=headers))) as r:
+                hasher = hashlib.md5()
+                buf = bytearray()
+                while chunk := r.read(65536):
+                    hasher.update(chunk)
+                    buf.extend(chunk)
+                newhash = hasher.hexdigest()
+                self.listetag = r.headers.get('ETag', "")
+                self.listmodified = r.headers.get('Last-Modified', "")
+        except error.HTTPError as e:
+            if e.code != 304:
+                raise
+            # The error carries the response and its socket; release them now, not at garbage collection.
+            e.close()
+            logging.info("Remote playlist not modified.")
+        # The hash may have been loaded from disk at startup, in which case there's nothing parsed yet.
+        if buf is not None and (newhash != self.listhash or not self.listcandidates):
+            self.listcandidates = self.parsePlaylist(buf.decode('utf-8', 'replace'))
+        # Update the playlist immediately if the source file changed!
+        # Otherwise, check the gas tank. Pre-render if we're not full.
+        # If we're full, just sleep for 60 seconds.
+        if (newhash != self.listhash):
+            logging.info("Remote playlist updated!")
+            self.listhash = newhash
+            # Remember it across restarts, so an unchanged playlist doesn't count as an update.
+            Path(self.mediapath, '.listhash').write_text(newhash)
+            self.updatePlaylist(self.listcandidates)
+        elif self.checkGas() < self.gastanklimit:
+            logging.info(f'Filling up gas tank! ({self.gastank} of {self.gastanklimit} seconds ready...)')
+            self.updatePlaylist(self.listcandidates)
+        else:
+            logging.info(f'Gas tank is at {self.gastank} seconds, so wait...')
+            # Sleep until the gas tank falls below full.
+            # The extra second makes sure it's actually below, and never sleep for less than that.
+            time.sleep(max(1.0, self.gastank - self.gastanklimit + 1.0))
 
     def checkGas(self):
         # Reduce gastank by the time elapsed since last elapsedtime.
         # Then return the current value of gastank.
-        curtime = time.time()
+        curtime = time.monotonic()
         newelapsed = curtime - self.starttime
         gasused = newelapsed - self.elapsedtime
         logging.info(f'Elapsed since start: {newelapsed}')
@@ -167,122 +231,97 @@ class djmarinara:
         candidates = []
         # Wrap the entire zipfile block
         # Don't want it to blow up the entire program!
+        # Nothing is extracted to temppath any more, so there's no directory to create or clean up.
         try:
             with zipfile.ZipFile(zf, "r") as zip_ref:
-                try:
-                    os.makedirs(self.temppath)
-                except:
-                    pass
-                try:
-                    zip_ref.extractall(self.temppath)
-                    for root, dirs, files in os.walk(self.temppath):
-                        for file in files:
-                            filelower = file.lower()
-                            extension = filelower.split(".")[-1]
-                            if extension in self.extensions:
-                                candidatepath = os.path.join(root, file)
-                                candidatepath = candidatepath.replace("\\", "/")
-                                candidates.append(candidatepath)
-                                logging.info(f'Candidate file: {candidatepath}')
-                except:
-                    # Naughty zip file!
-                    # Just skip it.
-                    logging.error(f'Bad zip file: {zf}')
-                    logging.error("We'll skip this one...")
-        except:
+                # Choose from the archive's directory, then decompress only the chosen entry.
+                for info in zip_ref.infolist():
+                    if info.is_dir():
+                        continue
+                    extension = info.filename.lower().split(".")[-1]
+                    if extension in self.extensions:
+                        candidates.append(info)
+                        logging.info(f'Candidate file: {info.filename}')
+                if len(candidates) > 0:
+                    choice = random.choice(candidates)
+                    playfile = choice.filename.replace("\\", "/").split("/")[-1].lower()
+                    # A nested zip can share its parent's name; don't overwrite the archive we're reading.
+                    if playfile == zf:
+                        playfile = "nested-" + playfile
+                    with zip_ref.open(choice) as src, open(playfile, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+        except Exception as e:
+            # Naughty zip file!
+            # Just skip it.
             logging.error(f'Bad zip file: {zf}')
+            logging.error(e)
             logging.error("We'll skip this one...")
-        if len(candidates) > 0:
-            choice = random.choice(candidates)
-            playfile = choice.split("/")[-1].lower()
-            shutil.move(choice, playfile)
-        # Now clean up.
-        for filename in os.listdir(self.temppath):
-            filepath = os.path.join(self.temppath, filename)
-            try:
-                shutil.rmtree(filepath)
-            except OSError:
-                os.remove(filepath)
+            playfile = ""
         os.remove(zf)
         return playfile
 
-    def processFile(self, file):
-        processstart = time.time()
+    def processFile(self, file, nextfile=None):
+        processstart = time.monotonic()
         filename = file.split("/")[-1].lower()
         logging.info(f'Filename: {filename}')
-        parts = file.split("://")
-        protocol = parts[0]
-        urlstring = parts[1]
-        newfile = protocol + "://" + parse.quote(urlstring)
-        logging.info(f'Parsed: {newfile}')
         try:
-            with closing(request.urlopen(newfile)) as r:
-                logging.info(f'Opening URL: {file}')
-                with open(filename, 'wb') as f:
-                    logging.info(f'Downloading: {filename}')
-                    shutil.copyfileobj(r, f)
-                # ZIP files need to be extracted and scanned.
-                if filename.endswith('.zip'):
-                    sourcefile = self.processZip(filename)
-                    # The returned file might be znother zip!
-                    # Process it, too.
-                    while sourcefile.endswith('.zip'):
-                        sourcefile = self.processZip(sourcefile)
-                else:
-                    sourcefile = filename
-                # No file? No sleep!
-                # No file at this point means something went wrong acquiring the source
-                if sourcefile == "":
-                    return 0
-                # Convert the file into a video we can queue
-                filedata = self.convertFile(sourcefile)
-                # Should get back a dictionary.
-                # No file? No sleep!
-                # No file at this point means we couldn't convert for some reason
-                if 'playfile' not in filedata.keys():
-                    # Clean up the original file if we couldn't convert it
-                    os.remove(sourcefile)
-                    return 0
-                else:
-                    playfile = filedata['playfile']
-                # Copy file to destination
-                # It's expected that playfile is in the current directory
-                logging.info(f'Queueing: {playfile}')
-                shutil.copy(playfile, self.mediapath + "/" + playfile)
-                # Add playfile to a playlist in /media
-                # Increment filenumber
-                self.filenumber += 1
-                playlistfile = self.mediapath + "/playlist" + str(self.filenumber) + ".txt"
-                playlist = open(playlistfile, 'w')
-                playlist.write("ffconcat version 1.0\n")
-                playlist.write("file " + playfile + "\n")
-                playlist.write("file playlist" + str(self.filenumber + 1) + ".txt\n")
-                # Clean up local file(s)
-                os.remove(playfile)
-                # Add duration to the gas tank
-                self.gastank += float(filedata['duration'])
-            processend = time.time()
+            if self.prefetch is not None and self.prefetch[0] == file:
+                # Already downloaded in the background while the last song rendered.
+                logging.info(f'Using prefetched download: {filename}')
+                future = self.prefetch[2]
+                self.prefetch = None
+                future.result()
+            else:
+                self.downloadFile(file, filename)
+            # ZIP files need to be extracted and scanned.
+            if filename.endswith('.zip'):
+                sourcefile = self.processZip(filename)
+                # The returned file might be znother zip!
+                # Process it, too.
+                while sourcefile.endswith('.zip'):
+                    sourcefile = self.processZip(sourcefile)
+            else:
+                sourcefile = filename
+            # No file? No sleep!
+            # No file at this point means something went wrong acquiring the source
+            if sourcefile == "":
+                return 0
+            # Fetch the next song in the background while this one renders.
+            self.startPrefetch(nextfile)
+            # Convert the file into a video we can queue
+            filedata = self.convertFile(sourcefile)
+            # Should get back a dictionary.
+            # No file? No sleep!
+            # No file at this point means we couldn't convert for some reason
+            if 'playfile' not in filedata.keys():
+                # Clean up the original file if we couldn't convert it
+                os.remove(sourcefile)
+                return 0
+            else:
+                playfile = filedata['playfile']
+            # Copy file to destination
+            # It's expected that playfile is in the current directory
+            logging.info(f'Queueing: {playfile}')
+            shutil.copy(playfile, self.mediapath + "/" + playfile)
+            # Add playfile to a playlist in /media
+            # Increment filenumber
+            self.filenumber += 1
+            playlistfile = self.mediapath + "/playlist" + str(self.filenumber) + ".txt"
+            self.writePlaylist(playlistfile, playfile, "playlist" + str(self.filenumber + 1) + ".txt")
+            # Clean up local file(s)
+            os.remove(playfile)
+            # Add duration to the gas tank
+            self.gastank += float(filedata['duration'])
+            processend = time.monotonic()
             processtook = processend - processstart
             ratio = float(filedata['duration']) / processtook
             logging.info(f'File processing took {processtook} seconds, ran at {ratio} x...')
-            # Reduce quality to improve render time
-            # Or improve quality if we have render time to spare
-            if ratio < self.targetspeed:
-                self.crf += 1
-            elif ratio > self.targetspeed:
-                self.crf -= 1
-            self.crf = self.clamp(self.crf, self.mincrf, self.maxcrf)
-            # Adjust quality preset, too
-            if ratio < (self.targetspeed - 0.5) and self.preset > 0:
-                # Too slow
-                # Faster preset!
-                self.preset -= 1
-            elif ratio > (self.targetspeed + 0.5) and self.preset < 8:
-                # Too fast
-                # Slower preset!
-                self.preset += 1
-            logging.info(f'Quality preset is now: {self.qualitypresets[self.preset]}')
-            logging.info(f'CRF is now: {self.crf}')
+            self.adjustQuality(ratio)
+            if self.encoder == 'h264_nvenc':
+                logging.info(f'NVENC preset is now: p{round(self.nvencpreset)}')
+            else:
+                logging.info(f'Quality preset is now: {self.qualitypresets[self.preset]}')
+                logging.info(f'CRF is now: {self.crf:.2f}')
         except Exception as e:
             logging.error(f'Failed to obtain or process file:{filename}')
             logging.error('-' * 60)
@@ -291,6 +330,63 @@ class djmarinara:
             return 0
         return 1
 
+    def downloadFile(self, file, filename):
+        parts = file.split("://")
+        protocol = parts[0]
+        urlstring = parts[1]
+        newfile = protocol + "://" + parse.quote(urlstring)
+        logging.info(f'Parsed: {newfile}')
+        self.streamToFile(newfile, filename)
+
+    def startPrefetch(self, file):
+        # Only one download runs ahead of the encoder at a time.
+        if file is None or self.prefetch is not None:
+            return
+        filename = file.split("/")[-1].lower()
+        # Never clobber a file that's being worked on right now.
+        if os.path.exists(filename):
+            return
+        logging.info(f'Prefetching: {file}')
+        self.prefetch = (file, filename, self.downloader.submit(self.downloadFile, file, filename))
+
+    def dropPrefetch(self):
+        # Wait out the download; cleanCache removes the file once it's no longer claimed.
+        file, filename, future = self.prefetch
+        self.prefetch = None
+        logging.info(f'Discarding prefetched download: {filename}')
+        try:
+            future.result()
+        except Exception as e:
+            logging.error(f'Prefetch failed for: {file}')
+            logging.error(e)
+
+    def adjustQuality(self, ratio):
+        # PI controller on render speed, in incremental form since CRF itself accumulates the steps.
+        # Positive error means we rendered too slowly. Normalizing by the target makes the step
+        # scale with how far off we were, so a cold start converges in a few songs
+        # instead of creeping one CRF at a time.
+        # CRF stays fractional (x264 accepts that), so small errors still add up instead of rounding away.
+        speederror = (self.targetspeed - ratio) / self.targetspeed
+        step = 2.0 * (speederror - self.speederror) + 8.0 * speederror
+        self.speederror = speederror
+        if self.encoder == 'h264_nvenc':
+            # CRF doesn't apply at constant bitrate, so the preset is the only speed knob.
+            # Too slow (positive step) means a faster, lower-numbered preset.
+            # There are 7 presets against 11 CRF values, so take half-size steps.
+            self.nvencpreset = self.clamp(self.nvencpreset - 0.5 * step, 1.0, 7.0)
+            return
+        newcrf = self.clamp(self.crf + step, self.mincrf, self.maxcrf)
+        # CRF pinned at a limit and still pushing past it? Move the preset instead.
+        if step > 0 and newcrf == self.maxcrf and self.crf == self.maxcrf and self.preset > 0:
+            # Too slow
+            # Faster preset!
+            self.preset -= 1
+        elif step < 0 and newcrf == self.mincrf and self.crf == self.mincrf and self.preset < 8:
+            # Too fast
+            # Slower preset!
+            self.preset += 1
+        self.crf = newcrf
+
     def convertFile(self, file):
         # First need to probe file to obtain some info about it
         logging.info(f'Probing: {file} ...')
@@ -300,18 +396,16 @@ class djmarinara:
                                   'quiet',
                                   '-print_format',
                                   'json=compact=1',
-                                  '-show_format'],
+                                  # Only what makeText and the checks below use, not every tag
+                                  '-show_entries',
+                                  'format=filename,duration:format_tags=title,artist,comment'],
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.STDOUT)
         filejson = json.loads(probe.communicate()[0].decode("utf-8"))
         # Example:
-        # {'format': {'filename': 'funksqua.s3m', 'nb_streams': 1,
-        #   'nb_programs': 0, 'format_name': 'libopenmpt',
-        #   'format_long_name': 'Tracker formats (libopenmpt)',
-        #   'duration': '206.400000', 'size': '352720',
-        #   'bit_rate': '13671', 'probe_score': 76, 'tags':
-        #     {'title': 'Funky Squad',
-        #     'encoder': 'Scream Tracker 3.20', 'comment':
+        # {'format': {'filename': 'funksqua.s3m',
+        #   'duration': '206.400000', 'tags':
+        #     {'title': 'Funky Squad', 'comment':
         #       'Funky Squad by\n             FireLight\n\nInspired by those hip \ncats the d-generation \nand their tv show\nfunky squad :)\nOriginal guitar samples\nmade at a friends house\nusing his guitar+wah pedal.\nSupports the global volume\neffect (fade out at end) &\nfine vibrato so make sure\nyou use a decent player.\n'
         # }}}
         filedata = {}
@@ -352,74 +446,66 @@ class djmarinara:
             logging.info(filedata['comments'])
         filecount = str(self.filenumber + 1)
         filedata['playfile'] = 'media' + filecount + '.flv'
-        filedata['textfile'] = 'media' + filecount + '.txt'
+        filedata['spritefile'] = 'media' + filecount + '.png'
         self.makeText(filedata)
         # Then, convert to a video
-        # ffmpeg -i [FILE] -y -loglevel warning -nostats -hide_banner -filter_complex "[0:a]showcqt=sono_h=0:axis=0:s=1920x1080:fps=30:bar_h=1080:cscheme=1|0|1|0|1|0:csp=bt470bg[left]; [left] drawtext=fontfile=/usr/share/fonts/TTF/Vera.ttf:fontcolor=white:x=20:y=h-mod(max(t-0.0\,0)*(h+th)/44.0\,(h+th)):text='\"Song Title\" by Artist'[out]" -map "[out]" -map 0:a -c:v libx264 -preset ultrafast -tune fastdecode -crf 31 -ar 44100 -c:a aac output.flv
+        # ffmpeg -i [FILE] -i [TEXT PNG] -y -loglevel warning -nostats -hide_banner -filter_complex "[0:a]silenceremove=start_periods=1:stop_periods=1:detection=peak,aresample=44100,asplit=2[viz][aout]; [viz]showcqt=sono_h=0:axis=0:s=1920x1080:fps=30:bar_h=1080:cscheme=1|0|1|0|1|0:csp=bt470bg[left]; [left][1:v] overlay=x=20:y=H-mod(max(t-0.0\,0)*(H+h)/44.0\,(H+h))[out]" -map "[out]" -map "[aout]" -c:v libx264 -preset ultrafast -tune fastdecode -crf 31 -c:a aac output.flv
         logging.info(f'Converting {file} to {filedata.get("playfile")} ...')
-        # First conversion trims starting/ending silence and turns into AAC.
-        convert = subprocess.Popen(["ffmpeg",
-                                    "-i",
-                                    file,
-                                    "-y",
-                                    "-loglevel", "warning",
-                                    "-nostats",
-                                    "-hide_banner",
-                                    "-af",
-                                    r"silenceremove=start_periods=1:stop_periods=1:detection=peak",
-                                    "-ar", "44100",
-                                    "-c:a", "aac",
-                                    "-b:a", "128k",
-                                    "out.aac"],
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT)
-        logging.info(convert.communicate()[0].decode("utf-8"))
-        # Duration may have changed, so check it again.
+        # Trims starting/ending silence. Applied in both passes below.
+        silencefilter = r"silenceremove=start_periods=1:stop_periods=1:detection=peak"
+        # Duration may change after trimming silence, so measure it first.
+        # The null muxer only decodes and filters; nothing is encoded or written to disk.
         probe = subprocess.Popen(['ffmpeg',
                                   '-nostdin',
                                   '-hide_banner',
                                   '-nostats',
                                   '-loglevel',
-                                  'info',
-                                  '-i', 'out.aac',
+                                  'error',
+                                  '-progress', 'pipe:1',
+                                  '-i', file,
+                                  '-af', silencefilter,
                                   '-f', 'null',
-                                  '-c', 'copy',
                                   '-'],
                                  stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT)
-        output = probe.communicate()[0].decode("utf-8")
-        logging.info(output)
-        newduration = output.split("time=")[1].split(" ")[0]
-        convertedduration = sum(x * float(t) for x, t in zip([1, 60, 3600], reversed(newduration.split(":"))))
+                                 stderr=subprocess.PIPE)
+        progress, errors = probe.communicate()
+        logging.info(errors.decode("utf-8"))
+        # Progress comes as key=value lines; the last out_time is where the trimmed audio ends.
+        # out_time_ms is in microseconds despite the name, same as out_time_us in newer builds.
+        convertedduration = None
+        for line in progress.decode("utf-8").splitlines():
+            key, _, value = line.partition("=")
+            if key in ('out_time_us', 'out_time_ms') and value.isdigit():
+                convertedduration = int(value) / 1000000.0
+        # No duration? No can do!
+        if probe.returncode != 0 or convertedduration is None:
+            logging.error(f'Skipping due to failed duration check (exit code {probe.returncode}): {file}')
+            return {}
         filedata['duration'] = convertedduration
         logging.info(f'True duration is: {filedata.get("duration")}')
 
         # Cap fadeouttime at 0 seconds; don't go negative!
         fadeouttime = max(0, float(filedata['duration']) - 5.0)
+        # Single render pass: the trimmed audio is split, one branch feeding the visualizer
+        # and the other going straight to the AAC encoder, so no intermediate file is needed.
         convert = subprocess.Popen(["ffmpeg",
                                     "-i",
-                                    "out.aac",
+                                    file,
+                                    "-i",
+                                    filedata['spritefile'],
                                     "-y",
                                     "-loglevel", "warning",
                                     "-nostats",
                                     "-hide_banner",
                                     "-filter_complex",
-                                    r"[0:a]showcqt=sono_h=0:axis=0:s=1920x1080:fps=30:bar_h=1080:cscheme=1|0|1|0|1|0:csp=bt470bg[left]; [left] hflip [left]; [left] drawtext=fontfile=font.ttf:fontsize=24:fontcolor=white:x=20:y=h-mod(max(t-0.0\,0)*(h+th)/50.0\,(h+th)):textfile=" +
-                                    filedata['textfile'] + " [out]; [out] fade=t=in:st=0:d=5,fade=t=out:st=" + str(
+                                    r"[0:a]" + silencefilter + r",aresample=44100,asplit=2[viz][aout]; [viz]showcqt=sono_h=0:axis=0:s=1920x1080:fps=30:bar_h=1080:cscheme=1|0|1|0|1|0:csp=bt470bg[left]; [left] hflip [left]; [left][1:v] overlay=x=20:y=H-mod(max(t-0.0\,0)*(H+h)/50.0\,(H+h)) [out]; [out] fade=t=in:st=0:d=5,fade=t=out:st=" + str(
                                         fadeouttime) + ":d=5 [out]",
                                     "-map", "[out]",
-                                    "-map", "0:a",
-                                    "-c:v", "libx264",
-                                    "-x264-params", "nal-hrd=cbr:force-cfr=1",
-                                    "-b:v", "4.5M",
-                                    "-preset", self.qualitypresets[self.preset],
-                                    "-tune", "fastdecode",
-                                    "-crf", str(self.crf),
-                                    "-maxrate", "4.5M",
-                                    "-minrate", "4.5M",
-                                    "-bufsize", "9M",
-                                    "-ar", "44100",
-                                    "-c:a", "copy",
+                                    "-map", "[aout]"] +
+                                   self.encoderOptions() +
+                                   ["-ar", "44100",
+                                    "-c:a", "aac",
+                                    "-b:a", "128k",
                                     "-g", "4",
                                     filedata['playfile']],
                                    stdout=subprocess.PIPE,
@@ -432,19 +518,73 @@ class djmarinara:
             return {}
         # Remove original file
         os.remove(file)
-        # Remove metadata text file
-        os.remove(filedata['textfile'])
-        # Remove reference to text file
-        del filedata['textfile']
+        # Remove metadata text sprite
+        os.remove(filedata['spritefile'])
+        # Remove reference to text sprite
+        del filedata['spritefile']
         return filedata
 
+    def detectEncoder(self):
+        # Prefer NVENC, but only if a tiny test encode works.
+        # ffmpeg lists h264_nvenc whether or not there's a GPU to run it on.
+        # Test with the exact options the render will use: older ffmpeg builds
+        # (before 4.3) have NVENC but not the p1-p7 presets or the ll tune.
+        try:
+            probe = subprocess.Popen(['ffmpeg',
+                                      '-nostdin',
+                                      '-hide_banner',
+                                      '-loglevel', 'error',
+                                      '-f', 'lavfi',
+                                      '-i', 'color=s=256x256:d=0.1'] +
+                                     self.nvencOptions() +
+                                     ['-f', 'null',
+                                      '-'],
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+            probe.communicate()
+            if probe.returncode == 0:
+                logging.info("Encoding with h264_nvenc")
+                return 'h264_nvenc'
+        except OSError as e:
+            logging.error(e)
+        logging.info("Encoding with libx264")
+        return 'libx264'
+
+    def encoderOptions(self):
+        if self.encoder == 'h264_nvenc':
+            return self.nvencOptions()
+        return self.x264Options()
+
+    def nvencOptions(self):
+        # The GPU encodes at constant bitrate, so CRF doesn't apply.
+        # The speed controller picks the preset instead: p1 (fastest) to p7 (slowest).
+        return ["-c:v", "h264_nvenc",
+                "-preset", "p" + str(round(self.nvencpreset)),
+                "-tune", "ll",
+                "-rc", "cbr",
+                "-b:v", "4.5M",
+                "-maxrate", "4.5M",
+                "-bufsize", "9M"]
+
+    def x264Options(self):
+        return ["-c:v", "libx264",
+                "-threads", "0",
+                "-x264-params",
+                "nal-hrd=cbr:force-cfr=1:threads=auto:lookahead-threads=2:sliced-threads=0",
+                "-b:v", "4.5M",
+                "-preset", self.qualitypresets[self.preset],
+                "-tune", "fastdecode",
+                "-crf", f'{self.crf:.2f}',
+                "-maxrate", "4.5M",
+                "-minrate", "4.5M",
+                "-bufsize", "9M"]
+
     def makeText(self, data):
         # Check for:
         # data['title'] - Required
         # data['filename'] - Required
         # data['artist'] - Optional
         # data['comments'] - Optional
-        handle = open(data['textfile'], 'w', encoding='utf-8')
         outlines = []
         outlines.append("Title: " + data['title'] + "\n")
         if 'artist' in data.keys() and type(data['artist']) != type(None):
@@ -460,107 +600,143 @@ class djmarinara:
                     outlines.append(l + "\n")
             else:
                 outlines.append(data['comments'])
-        outstring = ""
-        for l in outlines:
-            if len(l) > self.linewidth:
-                outstring += "\n".join(
-                    textwrap.wrap(l, width=self.linewidth, expand_tabs=False, replace_whitespace=False,
-                                  drop_whitespace=False, break_long_words=False, break_on_hyphens=False))
-            else:
-                outstring += l
+        outstring = "".join("\n".join(self.wrapper.wrap(l)) if len(l) > self.linewidth else l for l in outlines)
         logging.info("Wrapped lines:")
         logging.info(outstring)
-        handle.write(outstring)
-        handle.close()
-
-    def updatePlaylist(self, inputlist):
+        # Rasterize the text once here, so the render only has to overlay pixels on each frame
+        # instead of running drawtext. Tabs are expanded the way drawtext did it.
+        outstring = outstring.expandtabs(4)
+        font = ImageFont.truetype('font.ttf', 24)
+        if hasattr(ImageDraw.ImageDraw, 'multiline_textbbox'):
+            measure = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+            left, top, right, bottom = measure.multiline_textbbox((0, 0), outstring, font=font)
+        else:
+            # Pillow 7 (Ubuntu 20.04's python3-pil) predates multiline_textbbox.
+            right, bottom = font.getsize_multiline(outstring)
+        sprite = Image.new('RGBA', (max(right, 1), max(bottom, 1)), (0, 0, 0, 0))
+        ImageDraw.Draw(sprite).multiline_text((0, 0), outstring, font=font, fill=(255, 255, 255, 255))
+        sprite.save(data['spritefile'])
+
+    def parsePlaylist(self, text):
+        # Keep only the lines we know how to play, so picking a song never has to retry on bad lines.
+        candidates = []
+        for line in text.splitlines():
+            line = line.strip()
+            if line.split(".")[-1].lower() in self.extensions:
+                candidates.append(line)
+        logging.info(f'Playlist has {len(candidates)} playable entries.')
+        return candidates
+
+    def updatePlaylist(self, candidates):
         # Queue up another song.
-        gotsong = 0
-        while not gotsong:
-            lines = inputlist.split("\\n")
-            choice = random.choice(lines)
-            extension = choice.split(".")[-1].lower()
-            if extension not in self.extensions:
-                continue
+        # Take one random ordering of the whole list, then walk it until a song processes successfully.
+        # Sampling leaves the cached candidate list untouched.
+        order = random.sample(candidates, len(candidates))
+        if self.prefetch is not None:
+            # Play the song we already downloaded, unless the playlist dropped it.
+            if self.prefetch[0] in order:
+                order.remove(self.prefetch[0])
+                order.insert(0, self.prefetch[0])
+            else:
+                self.dropPrefetch()
+        for index, choice in enumerate(order):
             logging.info(f'Selected: {choice}')
+            nextfile = order[index + 1] if index + 1 < len(order) else None
             # Process the selected file.
-            status = self.processFile(choice)
             # No sleep time? We didn't get a song!
-            if not status:
-                continue
-            else:
-                gotsong = 1
+            if self.processFile(choice, nextfile):
+                break
+        else:
+            # Every entry failed, or there weren't any. Don't hammer the playlist URL; try again later.
+            logging.error(f'Could not queue any of {len(order)} playlist entries. Waiting before trying again...')
+            time.sleep(60)
         self.cleanCache()
         self.updateStartup()
 
     def updateStartup(self):
         # Get the oldest playlist file that isn't playlist0.txt.
         # Update playlist0.txt to point to that playlist.
-        filelist = glob.glob(self.mediapath + '/playlist*.txt')
-        filelist.sort(key=self.naturalKeys)
-        # Remove playlist0.txt 
-        filelist.pop(0)
+        numbers = [self.fileNumber(name, 'playlist', '.txt') for name in os.listdir(self.mediapath)]
+        # Only the two lowest numbers matter; the first is playlist0.txt itself.
+        oldest = heapq.nsmallest(2, (number for number in numbers if number is not None))
         # If we have any files left, use the first one
-        try:
-            newfile = filelist.pop(0)
-            newplaylist = newfile.split("/")[-1]
-            logging.info(f'Updating playlist0.txt to start at {newplaylist} ...')
-            outfile = open('/media/playlist0.txt', 'w')
-            outfile.write("ffconcat version 1.0\n")
-            outfile.write("file startup.flv\n")
-            outfile.write("file " + newplaylist + "\n")
-            outfile.close()
-        except:
+        if len(oldest) < 2:
             # Didn't get a file, so don't change anything
-            pass
+            return
+        newplaylist = 'playlist' + str(oldest[1]) + '.txt'
+        logging.info(f'Updating playlist0.txt to start at {newplaylist} ...')
+        self.writePlaylist(os.path.join(self.mediapath, "playlist0.txt"), "startup.flv", newplaylist)
+
+    def writePlaylist(self, path, playfile, nextplaylist):
+        # ffconcat playlist: play one file, then chain on to the next playlist.
+        # Built up front and written in one go.
+        data = "ffconcat version 1.0\nfile " + playfile + "\nfile " + nextplaylist + "\n"
+        Path(path).write_bytes(data.encode("utf-8"))
 
     def cleanCache(self):
-        timeago = time.time() - 5400  # 90 minutes
-        filelist = glob.glob(self.mediapath + '/media*.flv')
-        filelist.sort(key=self.naturalKeys)
-        for file in filelist:
-            st = os.stat(os.path.join(self.mediapath, file))
-            mtime = st.st_mtime
-            if mtime < timeago:
-                logging.info(f'Cleaning up: {file}')
-                number = int(''.join(list(filter(str.isdigit, file))))
-                os.remove(os.path.join(self.mediapath, file))
-                os.remove(os.path.join(self.mediapath, 'playlist' + str(number) + '.txt'))
-        # Check disk space being used
-        # If we're over 80% we need to remove files until we fall under the threshold
-        filelist = glob.glob(self.mediapath + '/media*.flv')
-        filelist.sort(key=self.naturalKeys)
-        diskusage = shutil.disk_usage(self.mediapath)
-        diskpercent = (diskusage.used / diskusage.total) * 100.0
-        logging.info(f'Disk usage: {diskusage.used} of {diskusage.total} ({diskpercent}%)')
-        while (diskusage.used / diskusage.total) > 0.8:
-            done = 0
-            while not done:
+        timeago = time.time() - 5400  # 90 minutes (wall clock, to compare with file mtimes)
+        # Scan the media directory once. DirEntry keeps its path and stat result,
+        # and the numeric suffix gives the play order without any regex sorting.
+        filelist = []
+        with os.scandir(self.mediapath) as it:
+            for entry in it:
+                number = self.fileNumber(entry.name, 'media', '.flv')
+                if number is not None:
+                    filelist.append((number, entry))
+        filelist.sort(key=lambda item: item[0])
+        # Unlink relative to one open handle on the media directory instead of resolving full paths each time.
+        dirfd = os.open(self.mediapath, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        try:
+            remaining = []
+            for number, entry in filelist:
+                if entry.stat().st_mtime < timeago:
+                    logging.info(f'Cleaning up: {entry.path}')
+                    self.removeMedia(dirfd, number)
+                else:
+                    remaining.append((number, entry))
+            # Check disk space being used
+            # If we're over 80% we need to remove files until we fall under the threshold
+            diskusage = shutil.disk_usage(self.mediapath)
+            diskpercent = (diskusage.used / diskusage.total) * 100.0
+            logging.info(f'Disk usage: {diskusage.used} of {diskusage.total} ({diskpercent}%)')
+            while (diskusage.used / diskusage.total) > 0.8:
                 # Can't operate on an empty list
-                if len(filelist) == 0:
+                if len(remaining) == 0:
                     return
-                item = filelist.pop(0)
-                logging.info(f'Removing file to free up disk: {item}')
-                number = int(''.join(list(filter(str.isdigit, item))))
-                os.remove(os.path.join(self.mediapath, item))
-                os.remove(os.path.join(self.mediapath, 'playlist' + str(number) + '.txt'))
-                done = 1
-            diskusage = shutil.disk_usage(self.mediapath)
+                number, entry = remaining.pop(0)
+                logging.info(f'Removing file to free up disk: {entry.path}')
+                self.removeMedia(dirfd, number)
+                diskusage = shutil.disk_usage(self.mediapath)
+        finally:
+            os.close(dirfd)
         # Finally, check for any files in the working directory
         # Delete them if present!
         # Only keep font.ttf and djmarinara.py
-        filelist = glob.glob('./*')
-        for file in filelist:
-            filename = Path(file).name
-            if filename not in self.manifest:
-                logging.info(f'Removing errant temporary file: {filename}')
-                os.remove(file)
-
-    def atoi(self, text):
-        return int(text) if text.isdigit() else text
-
-    def naturalKeys(self, text):
-        return [self.atoi(c) for c in re.split(r'(\d+)', text)]
+        with os.scandir('.') as it:
+            for entry in it:
+                # Hidden files were never matched by the old ./* glob; leave them alone.
+                if entry.name.startswith('.'):
+                    continue
+                # A download running ahead of the encoder isn't errant.
+                if self.prefetch is not None and entry.name == self.prefetch[1]:
+                    continue
+                if entry.name not in self.manifest:
+                    logging.info(f'Removing errant temporary file: {entry.name}')
+                    os.remove(entry.path)
+
+    def removeMedia(self, dirfd, number):
+        # A queued video and the playlist that plays it always go together.
+        os.unlink('media' + str(number) + '.flv', dir_fd=dirfd)
+        os.unlink('playlist' + str(number) + '.txt', dir_fd=dirfd)
+
+    def fileNumber(self, name, prefix, suffix):
+        # Numeric part of names like media12.flv or playlist12.txt.
+        # Returns None for anything that doesn't match.
+        if name.startswith(prefix) and name.endswith(suffix):
+            number = name[len(prefix):len(name) - len(suffix)]
+            if number.isdigit():
+                return int(number)
+        return None
 
     def clamp(self, n, minn, maxn):
         return max(min(maxn, n), minn)